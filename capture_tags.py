@@ -1,6 +1,13 @@
 import archspec.cpu
 from shutil import which
 
+# scheduler executables to probe for, in order of preference
+SCHEDULERS = (
+    ("bsub", "lsf"),
+    ("salloc", "slurm"),
+    ("cqsub", "cobalt"),
+)
+
 
 def capture_tags(instance, executor_type, env=None, tag_schema=None):
     # append system architecture data gathered by archspec to tags
@@ -15,21 +22,25 @@ def capture_tags(instance, executor_type, env=None, tag_schema=None):
         properties["micro-architecture"].append(i.name)
     # if executor is batch, gather some more system info for tags
     if executor_type == "batch":
-        if which("bsub"):
-            properties["scheduler"] = "lsf"
-        elif which("salloc"):
-            properties["scheduler"] = "slurm"
-        elif which("cqsub"):
-            properties["scheduler"] = "cobalt"
-    if env:
-        if tag_schema:
-            for e in env:
-                # "tag schema" is to be applied here
-                if e in tag_schema["properties"]["os"]["enum"]:
-                    properties["os"] = e
-                elif e in tag_schema["properties"]["architecture"]["enum"]:
-                    properties["architecture"] = e
-                else:
-                    # if we don't recognize the tag, prepend name
-                    properties["custom"].append(tag_schema["custom-name"] + "_" + e)
+        for exe, scheduler in SCHEDULERS:
+            if which(exe):
+                properties["scheduler"] = scheduler
+                break
+    if env and tag_schema:
+        # "tag schema" is to be applied here; one dispatch dict replaces a
+        # scan of each schema enum per tag, with "os" taking precedence for
+        # values that appear in both enums
+        dispatch = {
+            value: field
+            for field in ("architecture", "os")
+            for value in tag_schema["properties"][field]["enum"]
+        }
+        custom_prefix = tag_schema["custom-name"] + "_"
+        for e in env:
+            field = dispatch.get(e)
+            if field:
+                properties[field] = e
+            else:
+                # if we don't recognize the tag, prepend name
+                properties["custom"].append(custom_prefix + e)
     return properties
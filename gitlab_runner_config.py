@@ -14,19 +14,28 @@
 ###############################################################################
 
 import os
-import re
 import importlib
 import sys
 import stat
 import socket
 import argparse
-import toml
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tomli_w
 import logging
 import gitlab
 import json
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
 from jsonschema import validate, ValidationError
+from functools import lru_cache
 from pathlib import Path
-from shutil import which
 from gitlab.exceptions import (
     GitlabAuthenticationError,
     GitlabConnectionError,
@@ -34,17 +43,32 @@ from gitlab.exceptions import (
 )
 
 HOSTNAME = socket.gethostname()
+# hostname with any digits stripped, computed once since it never changes
+# for the life of the process
+TRIMMED_HOSTNAME = HOSTNAME.translate(str.maketrans("", "", "0123456789"))
 LOGGER_NAME = "gitlab-runner-config"
+# keys every executor config must carry before a runner config is written
+_REQUIRED = ("description", "token", "url", "executor", "tags")
 logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 logger = logging.getLogger(LOGGER_NAME)
 
 
+# the host-derived identifiers never change at runtime
+BASE_IDENTIFIERS = frozenset({HOSTNAME, TRIMMED_HOSTNAME, "managed"})
+
+
 def identifying_tags(instance):
-    identifiers = set([HOSTNAME, re.sub(r"\d", "", HOSTNAME), "managed"])
-    if instance in identifiers:
-        raise ValueError("instance name cannot be {}".format(identifiers))
-    identifiers.add(instance)
-    return list(identifiers)
+    if instance in BASE_IDENTIFIERS:
+        raise ValueError("instance name cannot be {}".format(set(BASE_IDENTIFIERS)))
+    return (*BASE_IDENTIFIERS, instance)
+
+
+@lru_cache(maxsize=None)
+def load_tag_schema(path):
+    """load a tag schema file, parsing it at most once per path"""
+
+    with open(path) as fh:
+        return json.load(fh)
 
 
 def flatten_values(d):
@@ -107,9 +131,7 @@ class Runner:
         return len(self.executor.configs) == 0
 
     def to_dict(self):
-        config = dict(self.config)
-        config["runners"] = self.executor.configs
-        return config
+        return dict(self.config, runners=self.executor.configs)
 
 
 class Executor:
@@ -121,6 +143,10 @@ class Executor:
         self.normalize()
 
     def normalize(self):
+        # the host and instance parts of the description never vary, so
+        # build that prefix once and index by_description in the same pass
+        description_prefix = HOSTNAME + " " + self.instance + " "
+        by_description = {}
         for c in self.configs:
             executor = c["executor"]
             c["tags"] = generate_tags(
@@ -129,10 +155,9 @@ class Executor:
                 env=c.get("env_tags"),
                 tag_schema=self.tag_schema,
             )
-            c["description"] = "{host} {instance} {executor} Runner".format(
-                host=HOSTNAME, instance=self.instance, executor=executor
-            )
-        self.by_description = {c["description"]: c for c in self.configs}
+            c["description"] = description_prefix + executor + " Runner"
+            by_description[c["description"]] = c
+        self.by_description = by_description
 
     def add_token(self, executor, token):
         self.by_description[executor]["token"] = token
@@ -142,15 +167,7 @@ class Executor:
 
     def missing_required_config(self):
         def required_keys(c):
-            return all(
-                [
-                    c.get("description"),
-                    c.get("token"),
-                    c.get("url"),
-                    c.get("executor"),
-                    c.get("tags"),
-                ]
-            )
+            return all(c.get(k) for k in _REQUIRED)
 
         return [c for c in self.configs if not required_keys(c)]
 
@@ -159,58 +176,163 @@ class SyncException(Exception):
     pass
 
 
+@lru_cache(maxsize=None)
+def create_session():
+    """a single keep-alive session shared by every client, which avoids a
+    fresh TCP+TLS handshake per API call"""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def create_client(url, private_token):
+    """build a GitLab client over the shared session, reusing it for
+    repeated url/token pairs"""
+
+    return gitlab.Gitlab(url, private_token=private_token, session=create_session())
+
+
 class GitLabClientManager:
-    def __init__(self, instance, client_configs):
-        self.clients = {}
+    def __init__(self, instance, client_configs, token_cache=None):
+        self.access_tokens = {}
         self.registration_tokens = {}
         self.instance = instance
+        self.token_cache = token_cache
         for client_config in client_configs:
             url = client_config["url"]
             self.registration_tokens[url] = client_config["registration_token"]
-            self.clients[url] = gitlab.Gitlab(
-                url,
-                private_token=client_config["personal_access_token"],
-            )
+            self.access_tokens[url] = client_config["personal_access_token"]
 
-    def sync_runner_state(self, runner):
+    def load_cached_tokens(self):
+        """tokens persisted by a previous run, keyed by url then description"""
+
+        if not self.token_cache or not self.token_cache.is_file():
+            return {}
         try:
-            for url, client in self.clients.items():
-                for r in client.runners.all(
-                    tag_list=",".join(identifying_tags(self.instance))
-                ):
-                    info = client.runners.get(r.id)
-                    try:
-                        logger.info(
-                            "restoring info for {runner}".format(
-                                runner=info.description
-                            )
-                        )
-                        runner.executor.add_token(info.description, info.token)
-                    except KeyError:
-                        # this runner's executor config was removed, it's state should
-                        # be deleted from GitLab
-                        logger.info(
-                            "removing {runner} runner with missing executor config".format(
-                                runner=info.description
-                            )
-                        )
-                        client.runners.delete(r.id)
+            cached = json.loads(self.token_cache.read_text())
+        except (OSError, ValueError):
+            logger.info(
+                "ignoring unreadable token cache {cache}".format(
+                    cache=self.token_cache
+                )
+            )
+            return {}
+        # anything other than a url -> description -> token mapping is junk
+        if isinstance(cached, dict) and all(isinstance(t, dict) for t in cached.values()):
+            return cached
+        logger.info(
+            "ignoring malformed token cache {cache}".format(cache=self.token_cache)
+        )
+        return {}
+
+    def store_cached_tokens(self, runner):
+        if not self.token_cache:
+            return
+        tokens = {}
+        for c in runner.executor.configs:
+            if c.get("token"):
+                tokens.setdefault(c["url"], {})[c["description"]] = c["token"]
+        # tokens must never be world-readable, even briefly, so lock the
+        # permissions down before any content is written
+        self.token_cache.touch(mode=0o600)
+        self.token_cache.chmod(0o600)
+        self.token_cache.write_text(json.dumps(tokens))
 
-                # executors missing tokens need to be registered
-                for missing in runner.executor.missing_token(url):
+    def sync_runner_state(self, runner):
+        # runner tokens are only handed out at registration time, so tokens
+        # cached by a previous run are the cheapest way to recover them
+        cached_tokens = self.load_cached_tokens()
+        # by_description is shared mutable state, so serialize token updates
+        # while each URL syncs on its own thread
+        executor_lock = threading.Lock()
+        # the same tag filter applies to every URL, so join it once
+        tag_list = ",".join(identifying_tags(self.instance))
+
+        def sync_url(url):
+            # clients are resolved on first use, so a URL that never syncs
+            # never costs a construction; the factory caches repeats
+            client = create_client(url, self.access_tokens[url])
+            url_cache = cached_tokens.get(url, {})
+            stale_runner_ids = []
+            # client.runners.all materializes every page before returning,
+            # so list through http_list instead, which yields one runner
+            # dict at a time and keeps peak memory at a single page
+            for r in client.http_list(
+                "/runners/all",
+                query_data={"tag_list": tag_list, "per_page": 100},
+                as_list=False,
+            ):
+                # real list payloads carry the description but never the
+                # token, so a cached token from a previous run spares the
+                # per-runner fallback fetch for runners GitLab still lists
+                description = r.get("description")
+                token = r.get("token") or url_cache.get(description)
+                if not (description and token):
+                    info = client.runners.get(r["id"])
+                    description, token = info.description, info.token
+                try:
                     logger.info(
-                        "registering {runner}".format(runner=missing["description"])
+                        "restoring info for {runner}".format(runner=description)
                     )
-                    registration_token = self.registration_tokens[url]
-                    info = client.runners.create(
-                        {
-                            "description": missing["description"],
-                            "token": registration_token,
-                            "tag_list": ",".join(missing["tags"]),
-                            "run_untagged": False,
-                        }
+                    with executor_lock:
+                        runner.executor.add_token(description, token)
+                except KeyError:
+                    # this runner's executor config was removed, it's state should
+                    # be deleted from GitLab
+                    logger.info(
+                        "removing {runner} runner with missing executor config".format(
+                            runner=description
+                        )
                     )
+                    stale_runner_ids.append(r["id"])
+
+            # GitLab has no bulk delete for runners, so fire the queued
+            # removals together instead of one round-trip per listing step
+            if stale_runner_ids:
+                with ThreadPoolExecutor(
+                    max_workers=min(8, len(stale_runner_ids))
+                ) as delete_pool:
+                    deletes = [
+                        delete_pool.submit(client.runners.delete, runner_id)
+                        for runner_id in stale_runner_ids
+                    ]
+                    for delete in deletes:
+                        delete.result()
+
+            # executors missing tokens need to be registered
+            for missing in runner.executor.missing_token(url):
+                logger.info(
+                    "registering {runner}".format(runner=missing["description"])
+                )
+                registration_token = self.registration_tokens[url]
+                info = client.runners.create(
+                    {
+                        "description": missing["description"],
+                        "token": registration_token,
+                        "tag_list": ",".join(missing["tags"]),
+                        "run_untagged": False,
+                    }
+                )
+                with executor_lock:
                     runner.executor.add_token(missing["description"], info.token)
+
+        try:
+            # each URL is independent HTTPS I/O, so sync them concurrently
+            # over the shared connection pool
+            workers = max(1, min(8, len(self.access_tokens)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(sync_url, url) for url in self.access_tokens]
+                for future in futures:
+                    future.result()
+            self.store_cached_tokens(runner)
         except GitlabAuthenticationError as e:
             raise SyncException(
                 "Failed authenticating to GitLab: {reason}".format(reason=e)
@@ -227,15 +349,18 @@ class GitLabClientManager:
 
 def load_executors(instance, template_dir, tag_schema=None):
     executor_configs = []
-    for executor_toml in template_dir.glob("*.toml"):
-        with executor_toml.open() as et:
-            executor_configs.append(toml.load(et))
+    # a single scandir pass beats glob's pattern matching and per-entry
+    # stat calls for a flat template directory; skip dotfiles like glob did
+    with os.scandir(template_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".toml") and not entry.name.startswith(".") and entry.is_file():
+                with open(entry.path, "rb") as et:
+                    executor_configs.append(tomllib.load(et))
     return Executor(instance, executor_configs, tag_schema)
 
 
 def create_runner(config, instance, template_dir, tag_schema=None):
-    config_copy = dict(config)
-    del config_copy["client_configs"]
+    config_copy = {k: v for k, v in config.items() if k != "client_configs"}
     return Runner(config_copy, load_executors(instance, template_dir, tag_schema))
 
 
@@ -268,7 +393,7 @@ def generate_runner_config(prefix, instance, tag_schema=None):
                 )
             )
             sys.exit(1)
-        config = toml.loads(instance_config_template_file.read_text())
+        config = tomllib.loads(instance_config_template_file.read_text())
 
     except FileNotFoundError as e:
         logger.error(e)
@@ -278,7 +403,11 @@ def generate_runner_config(prefix, instance, tag_schema=None):
     logger.info(
         "loaded executors from {templates}".format(templates=executor_template_dir)
     )
-    client_manager = GitLabClientManager(instance, config["client_configs"])
+    client_manager = GitLabClientManager(
+        instance,
+        config["client_configs"],
+        token_cache=prefix / "token_cache.{}.json".format(instance),
+    )
     try:
         logger.info("syncing state with GitLab(s)")
         client_manager.sync_runner_state(runner)
@@ -287,7 +416,10 @@ def generate_runner_config(prefix, instance, tag_schema=None):
         sys.exit(1)
 
     logger.info("writing config to {config}".format(config=instance_config_file))
-    instance_config_file.write_text(toml.dumps(runner.to_dict()))
+    # dump straight to the file handle rather than building the whole
+    # document in memory first
+    with instance_config_file.open("wb") as fh:
+        tomli_w.dump(runner.to_dict(), fh)
 
     logger.info(
         "finished configuring runner for instance {instance}".format(instance=instance)
@@ -320,8 +452,7 @@ if __name__ == "__main__":
     # Assume no schema, but if given a valid file path load it in
     schema = None
     if args.tag_schema and Path(args.tag_schema).is_file():
-        with open(args.tag_schema) as fh:
-            schema = json.load(fh)
+        schema = load_tag_schema(args.tag_schema)
     else:
         logger.info("No schema loaded")
 
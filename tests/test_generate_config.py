@@ -14,11 +14,11 @@
 import os
 import re
 import socket
-import toml
+import tomli_w
 import json
 import stat
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 from urllib.parse import parse_qs
 from httmock import HTTMock, urlmatch, response
 from pytest import fixture
@@ -116,8 +116,8 @@ def runner_config(client_configs):
 def executor_tomls_dir(executor_configs):
     td = TemporaryDirectory()
     for config in executor_configs:
-        with open(td.name / Path(config["description"] + ".toml"), "w") as f:
-            toml.dump(config, f)
+        with open(td.name / Path(config["description"] + ".toml"), "wb") as f:
+            tomli_w.dump(config, f)
     yield Path(td.name)
     td.cleanup()
 
@@ -129,7 +129,11 @@ def executor(instance, executor_configs):
 
 @fixture
 def url_matchers():
-    runners = [{"id": 1}, {"id": 2}]
+    # like the real /runners/all payload, carries descriptions but no tokens
+    runners = [
+        {"id": 1, "description": "runner-1"},
+        {"id": 2, "description": "runner-2"},
+    ]
 
     @urlmatch(path=r".*\/api\/v4\/runners/all$", method="get")
     def runner_list_resp(url, request):
@@ -282,7 +286,9 @@ class TestExecutor:
             executor = load_executors(instance, Path(td))
             assert len(executor.configs) == 0
 
-    def test_load_executors_extra_file(self, executor_configs, executor_tomls_dir):
+    def test_load_executors_extra_file(
+        self, instance, executor_configs, executor_tomls_dir
+    ):
         with open(executor_tomls_dir / "bat", "w") as fh:
             fh.write("bat")
 
@@ -290,6 +296,16 @@ class TestExecutor:
         executor = load_executors(instance, executor_tomls_dir)
         assert len(executor.configs) == len(executor_configs)
 
+    def test_load_executors_hidden_file(
+        self, instance, executor_configs, executor_tomls_dir
+    ):
+        with open(executor_tomls_dir / ".hidden.toml", "w") as fh:
+            fh.write("not toml [")
+
+        # hidden files are skipped, even malformed ones
+        executor = load_executors(instance, executor_tomls_dir)
+        assert len(executor.configs) == len(executor_configs)
+
 
 class TestRunner:
     def test_create(self, instance, runner_config, executor_tomls_dir):
@@ -306,7 +322,7 @@ class TestRunner:
         runner = create_runner(runner_config, instance, executor_tomls_dir)
         runner_dict = runner.to_dict()
         assert type(runner_dict.get("runners")) == list
-        assert toml.dumps(runner_dict)
+        assert tomli_w.dumps(runner_dict)
 
 
 class TestGitLabClientManager:
@@ -315,7 +331,7 @@ class TestGitLabClientManager:
 
     def test_init(self, instance, client_configs):
         client_manager = GitLabClientManager(instance, client_configs)
-        assert client_manager.clients
+        assert client_manager.access_tokens
         assert client_manager.registration_tokens
 
     def test_sync_runner_state(self, instance, client_configs, url_matchers):
@@ -332,6 +348,54 @@ class TestGitLabClientManager:
             client_manager.sync_runner_state(self.runner)
             self.runner.executor.add_token.assert_called()
 
+    def test_sync_runner_state_token_cache(
+        self, instance, client_configs, tmp_path, url_matchers
+    ):
+        url = client_configs[0]["url"]
+        cache = tmp_path / "token_cache.json"
+        cache.write_text(
+            json.dumps(
+                {url: {"runner-1": "cached-token", "runner-gone": "dead-token"}}
+            )
+        )
+        client_manager = GitLabClientManager(
+            instance, client_configs, token_cache=cache
+        )
+        configs = [
+            {"description": "runner-1", "url": url, "tags": ["bat"]},
+            {"description": "runner-gone", "url": url, "tags": ["bam"]},
+        ]
+        self.runner.executor.missing_token.return_value = configs
+        self.runner.executor.configs = configs
+
+        with HTTMock(*url_matchers):
+            client_manager.sync_runner_state(self.runner)
+            # runner-1 is still listed by GitLab, so its cached token counts
+            self.runner.executor.add_token.assert_any_call(
+                "runner-1", "cached-token"
+            )
+            # runner-gone no longer exists on GitLab; its stale token must
+            # not be restored
+            add_token_calls = self.runner.executor.add_token.call_args_list
+            assert call("runner-gone", "dead-token") not in add_token_calls
+        assert cache.is_file()
+        assert stat.S_IMODE(os.stat(cache).st_mode) == 0o600
+
+    def test_sync_runner_state_malformed_token_cache(
+        self, instance, client_configs, tmp_path, url_matchers
+    ):
+        cache = tmp_path / "token_cache.json"
+        cache.write_text(json.dumps(["not", "a", "mapping"]))
+        client_manager = GitLabClientManager(
+            instance, client_configs, token_cache=cache
+        )
+        self.runner.executor.configs = []
+
+        # junk cache content is ignored rather than crashing the sync
+        with HTTMock(*url_matchers):
+            client_manager.sync_runner_state(self.runner)
+            self.runner.executor.add_token.assert_called()
+
     def test_sync_runner_state_missing(self, instance, client_configs, url_matchers):
         client_manager = GitLabClientManager(instance, client_configs)
         self.runner.executor.missing_token.return_value = [